@@ -1,10 +1,24 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+from openai import AsyncOpenAI
+from curl_cffi.requests import AsyncSession
+from contextlib import asynccontextmanager
+from urllib.parse import quote
+from cachetools import TLRUCache, cached
+from cachetools.func import ttl_cache
+from datetime import date
 import yfinance as yf
-import json
+import asyncio
+import threading
+import numpy as np
+from numba import njit
+import random
+import hashlib
+import orjson
 import uvicorn
 import os
 from dotenv import load_dotenv
@@ -13,15 +27,63 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # --- Initialize OpenAI ---
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# --- Persistent Yahoo session (opened in the app lifespan) ---
+yahoo_session = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Mantiene una sessione HTTP persistente verso Yahoo per tutta la vita del server"""
+    global yahoo_session
+    # curl_cffi con impronta TLS da browser (richiesta da Yahoo): le connessioni restano aperte
+    # tra le richieste e le chiamate concorrenti vengono multiplexate su HTTP/2
+    yahoo_session = AsyncSession(impersonate="chrome", max_clients=YAHOO_CONCURRENCY)
+    yield
+    await yahoo_session.close()
+
+# Prompt di sistema costante e sempre in prima posizione: il prefisso identico tra le richieste
+# permette a OpenAI di riutilizzarlo tramite il prompt caching automatico
+SYSTEM_PROMPT = {
+    "role": "system",
+    "content": (
+        "Sei un assistente finanziario che riceve domande in linguaggio naturale. "
+        "Devi restituire SOLO un JSON valido senza testo extra. "
+        "Struttura JSON: raggruppato per metriche richieste, poi per ticker, poi per periodi/dates. "
+        "Includi solo le metriche effettivamente richieste. "
+        "Normalizza tutti i periodi in termini che Yahoo Finance può comprendere: "
+        "`1mo`, `3mo`, `6mo`, `1y`, `5y`, `ytd` o anni specifici come `2022`, `2025`. "
+        "IMPORTANTE: Se non viene specificato esplicitamente un orizzonte temporale, usa `ytd` (Year-to-Date) come periodo predefinito. "
+        "Esempio generico:\n"
+        "{\n"
+        "  \"return\": {\"AAPL\": {\"1y\": null, \"ytd\": null}},\n"
+        "  \"compare\": {\"return\": {\"AAPL\": {\"ytd\": null}, \"GOOGL\": {\"ytd\": null}}}\n"
+        "}\n"
+        "Ticker: simboli ufficiali (Apple=AAPL, Google=GOOGL). "
+        "Metriche possibili: return, volatility, fundamentals, max_min, compare. "
+        "Non aggiungere testo fuori dal JSON."
+    )
+}
+
+SUMMARY_INSTRUCTIONS = (
+    "Analizza questo JSON finanziario e crea una risposta professionale e ben strutturata in italiano. "
+    "Usa un formato chiaro con paragrafi separati, numerazione quando appropriato, e un linguaggio tecnico ma accessibile. "
+    "Includi sempre i valori numerici specifici e le percentuali. "
+    "Struttura la risposta in questo modo: 1) Introduzione breve, 2) Dati principali con valori specifici, "
+    "3) Analisi comparativa se presente, 4) Conclusioni. JSON: "
+)
 
 class PromptRequest(BaseModel):
     prompt: str
+    stream: bool = False  # Se True, l'analisi testuale viene inviata come Server-Sent Events
+    include_nl: bool = True  # Se False, salta la seconda chiamata GPT e restituisce solo i dati
 
 app = FastAPI(
     title="Financial Data API",
     description="API per l'analisi di dati finanziari con supporto per linguaggio naturale",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Configurazione CORS
@@ -34,66 +96,241 @@ app.add_middleware(
 )
 
 # --- Finance functions (all JSON-serializable) ---
-def get_return(ticker, period):
-    """Calcola il rendimento percentuale di un ticker per un periodo specifico"""
+PRICE_METRICS = ("return", "volatility", "max_min")
+YAHOO_BATCH_SIZE = 20  # Numero massimo di simboli per singola richiesta a Yahoo
+MAX_FETCH_WORKERS = 10  # Richieste parallele massime verso Yahoo
+
+# yf.download condivide uno stato globale tra le chiamate: i download vanno serializzati
+download_lock = threading.Lock()
+
+# --- In-process TTL cache for Yahoo data ---
+PRICE_TTL_ROLLING = 60  # Storici che includono la seduta corrente
+PRICE_TTL_HISTORICAL = 24 * 3600  # Anni già chiusi: i prezzi non cambiano più
+FUNDAMENTALS_TTL = 3600
+CACHE_TTL_JITTER = 0.1  # Scadenze sfalsate del ±10% per evitare rinnovi simultanei
+
+def _jittered(ttl):
+    """Applica una variazione casuale al TTL"""
+    return ttl * random.uniform(1 - CACHE_TTL_JITTER, 1 + CACHE_TTL_JITTER)
+
+def _history_ttu(key, value, now):
+    """Scadenza di uno storico in cache, in base al periodo richiesto"""
+    period = key[1]
+    if period.isdigit() and int(period) < date.today().year:
+        return now + _jittered(PRICE_TTL_HISTORICAL)
+    return now + _jittered(PRICE_TTL_ROLLING)
+
+def _fundamentals_ttu(key, value, now):
+    """Scadenza dei fondamentali in cache"""
+    return now + _jittered(FUNDAMENTALS_TTL)
+
+# Le cache di cachetools non sono thread-safe: l'accesso passa sempre da cache_lock
+history_ttl_cache = TLRUCache(maxsize=2048, ttu=_history_ttu)
+fundamentals_ttl_cache = TLRUCache(maxsize=4096, ttu=_fundamentals_ttu)
+cache_lock = threading.Lock()
+
+def cache_get(cache, key):
+    """Legge un valore dalla cache, None se assente o scaduto"""
+    with cache_lock:
+        return cache.get(key)
+
+def cache_set(cache, key, value):
+    """Salva un valore in cache, ignorando i risultati vuoti"""
+    if value is None:
+        return
+    with cache_lock:
+        cache[key] = value
+
+# yfinance memorizza .info sull'istanza di Ticker: gli oggetti scadono prima della cache dei fondamentali
+@ttl_cache(maxsize=512, ttl=FUNDAMENTALS_TTL * (1 - CACHE_TTL_JITTER))
+def get_ticker(symbol):
+    """Restituisce un oggetto yf.Ticker riutilizzabile per il simbolo"""
+    return yf.Ticker(symbol)
+
+def _close_array(values):
+    """Converte i prezzi di chiusura in un array NumPy senza valori mancanti"""
+    close = np.asarray(values, dtype=float)
+    close = close[~np.isnan(close)]
+    return close if close.size else None
+
+def get_history(ticker, period):
+    """Scarica i prezzi di chiusura di un ticker per un periodo specifico"""
+    cached = cache_get(history_ttl_cache, (ticker, period))
+    if cached is not None:
+        return cached
     try:
-        data = yf.download(ticker, period=period, progress=False)
-        if data.empty or "Close" not in data:
-            return None
-        start_price = data["Close"].iloc[0]
-        end_price = data["Close"].iloc[-1]
-        return float(round((end_price - start_price) / start_price * 100, 2))
+        # Ticker.history evita il DataFrame MultiIndex e lo stato globale di yf.download
+        data = get_ticker(ticker).history(period=period, auto_adjust=False, actions=False)
+        close = _close_array(data["Close"])
     except Exception:
         return None
+    cache_set(history_ttl_cache, (ticker, period), close)
+    return close
+
+def get_histories(tickers, period):
+    """Scarica in blocco i prezzi di chiusura di più ticker per un periodo specifico"""
+    histories = {}
+    for t in dict.fromkeys(tickers):
+        cached = cache_get(history_ttl_cache, (t, period))
+        if cached is not None:
+            histories[t] = cached
+    tickers = [t for t in dict.fromkeys(tickers) if t not in histories]
+    for i in range(0, len(tickers), YAHOO_BATCH_SIZE):
+        chunk = tickers[i:i + YAHOO_BATCH_SIZE]
+        if len(chunk) == 1:
+            histories[chunk[0]] = get_history(chunk[0], period)
+            continue
+        try:
+            with download_lock:
+                data = yf.download(" ".join(chunk), period=period, group_by="ticker",
+                                   auto_adjust=False, progress=False, threads=True)
+        except Exception:
+            continue
+        if data is None or data.empty:
+            continue
+        downloaded = set(data.columns.get_level_values(0))
+        for t in chunk:
+            if t.upper() in downloaded:
+                histories[t] = _close_array(data[t.upper()]["Close"])
+                cache_set(history_ttl_cache, (t, period), histories[t])
+    return histories
+
+def _histories(tickers, period, prices=None):
+    """Restituisce gli storici dalla cache della richiesta, scaricando in blocco quelli assenti"""
+    prices = prices if prices is not None else {}
+    missing = [t for t in tickers if (t, period) not in prices]
+    fetched = get_histories(missing, period) if missing else {}
+    return {t: prices[(t, period)] if (t, period) in prices else fetched.get(t) for t in tickers}
+
+# --- Numeric kernels (compiled with Numba, input: closing prices without NaN) ---
+@njit(cache=True, fastmath=True)
+def _ret(close):
+    """Rendimento percentuale tra il primo e l'ultimo prezzo"""
+    return (close[-1] - close[0]) / close[0] * 100
+
+@njit(cache=True, fastmath=True)
+def _vol(close):
+    """Volatilità annualizzata dei rendimenti giornalieri (richiede almeno tre prezzi)"""
+    n = close.size - 1
+    mean = 0.0
+    for i in range(n):
+        mean += close[i + 1] / close[i] - 1.0
+    mean /= n
+    var = 0.0
+    for i in range(n):
+        r = close[i + 1] / close[i] - 1.0
+        var += (r - mean) * (r - mean)
+    return (var / (n - 1)) ** 0.5 * 252 ** 0.5 * 100
+
+@njit(cache=True, fastmath=True)
+def _minmax(close):
+    """Prezzo massimo e minimo"""
+    high = close[0]
+    low = close[0]
+    for i in range(1, close.size):
+        if close[i] > high:
+            high = close[i]
+        elif close[i] < low:
+            low = close[i]
+    return high, low
+
+# Compila i kernel all'avvio invece che alla prima richiesta
+_warmup = np.array([1.0, 2.0, 3.0])
+for _kernel in (_ret, _vol, _minmax):
+    _kernel(_warmup)
+
+def _rounded(value):
+    """Arrotonda un risultato numerico a due decimali"""
+    return float(np.round(value, 2))
+
+def close_stats(histories):
+    """Calcola rendimento, volatilità, massimo e minimo dai prezzi di chiusura di più ticker"""
+    stats = {}
+    for t, close in histories.items():
+        if close is None:
+            continue
+        high, low = _minmax(close)
+        stats[t] = {
+            "return": _rounded(_ret(close)),
+            # Con meno di due rendimenti giornalieri la deviazione standard non è definita
+            "volatility": _rounded(_vol(close)) if close.size > 2 else None,
+            "max": _rounded(high),
+            "min": _rounded(low),
+        }
+    return stats
+
+def _compute_return(data):
+    """Calcola il rendimento percentuale da uno storico già scaricato"""
+    stats = close_stats({None: data})
+    return stats[None]["return"] if stats else None
+
+def _compute_volatility(data):
+    """Calcola la volatilità annualizzata da uno storico già scaricato"""
+    stats = close_stats({None: data})
+    return stats[None]["volatility"] if stats else None
+
+def _compute_max_min(data):
+    """Ottiene i prezzi massimo e minimo da uno storico già scaricato"""
+    stats = close_stats({None: data})
+    return {"max": stats[None]["max"], "min": stats[None]["min"]} if stats else None
+
+def get_return(ticker, period):
+    """Calcola il rendimento percentuale di un ticker per un periodo specifico"""
+    return _compute_return(get_history(ticker, period))
 
 def get_volatility(ticker, period):
     """Calcola la volatilità annualizzata di un ticker per un periodo specifico"""
-    try:
-        data = yf.download(ticker, period=period, progress=False)
-        if data.empty or "Close" not in data:
-            return None
-        daily_returns = data["Close"].pct_change().dropna()
-        vol = daily_returns.std() * (252 ** 0.5)
-        return float(round(vol * 100, 2))
-    except Exception:
-        return None
+    return _compute_volatility(get_history(ticker, period))
 
 def get_max_min(ticker, period):
     """Ottiene i prezzi massimo e minimo di un ticker per un periodo specifico"""
+    return _compute_max_min(get_history(ticker, period))
+
+def _fast_market_cap(t):
+    """Ricava la capitalizzazione da fast_info quando .info non la riporta"""
+    # fast_info la calcola da numero di azioni e ultimo prezzo (due richieste extra): solo come ripiego
     try:
-        data = yf.download(ticker, period=period, progress=False)
-        if data.empty or "Close" not in data:
-            return None
-        return {
-            "max": float(round(data["Close"].max(), 2)),
-            "min": float(round(data["Close"].min(), 2))
-        }
+        return t.fast_info.market_cap
     except Exception:
         return None
 
+# I fondamentali cambiano di rado: restano in cache per FUNDAMENTALS_TTL. Gli errori non vengono
+# memorizzati e, grazie alla condition, i thread che chiedono lo stesso ticker attendono un solo download
+@cached(fundamentals_ttl_cache, condition=threading.Condition(cache_lock))
+def _fetch_fundamentals(ticker):
+    """Scarica i dati fondamentali di un ticker"""
+    t = get_ticker(ticker)
+    info = t.info
+    market_cap = info.get("marketCap") or _fast_market_cap(t)
+    return {
+        "longName": info.get("longName"),
+        "marketCap": float(market_cap) if market_cap else None,
+        "peRatio": float(info.get("trailingPE")) if info.get("trailingPE") else None,
+        "eps": float(info.get("trailingEps")) if info.get("trailingEps") else None,
+        "dividendYield": float(info.get("dividendYield")) if info.get("dividendYield") else None,
+        "debtToEquity": float(info.get("debtToEquity")) if info.get("debtToEquity") else None,
+    }
+
 def get_fundamentals(ticker):
     """Ottiene i dati fondamentali di un ticker"""
     try:
-        t = yf.Ticker(ticker)
-        info = t.info
-        return {
-            "longName": info.get("longName"),
-            "marketCap": float(info.get("marketCap")) if info.get("marketCap") else None,
-            "peRatio": float(info.get("trailingPE")) if info.get("trailingPE") else None,
-            "eps": float(info.get("trailingEps")) if info.get("trailingEps") else None,
-            "dividendYield": float(info.get("dividendYield")) if info.get("dividendYield") else None,
-            "debtToEquity": float(info.get("debtToEquity")) if info.get("debtToEquity") else None,
-        }
+        return _fetch_fundamentals(ticker)
     except Exception:
         return None
 
-def compare_returns(tickers: List[str], period: str):
+def get_fundamentals_many(tickers: List[str]):
+    """Ottiene in parallelo i dati fondamentali di più ticker"""
+    tickers = list(dict.fromkeys(tickers))
+    if not tickers:
+        return {}
+    # Le richieste a Yahoo sono I/O-bound: i thread si sovrappongono durante l'attesa di rete
+    with ThreadPoolExecutor(max_workers=min(len(tickers), MAX_FETCH_WORKERS)) as executor:
+        return dict(zip(tickers, executor.map(get_fundamentals, tickers)))
+
+def compare_returns(tickers: List[str], period: str, prices=None):
     """Confronta i rendimenti di più ticker per un periodo specifico"""
-    performances = {}
-    for t in tickers:
-        r = get_return(t, period)
-        if r is not None:
-            performances[t] = r
+    stats = close_stats(_histories(tickers, period, prices))
+    performances = {t: s["return"] for t, s in stats.items() if s["return"] is not None}
     if not performances:
         return {"error": "No data available for tickers"}
     best_ticker = max(performances, key=lambda k: performances[k])
@@ -103,13 +340,10 @@ def compare_returns(tickers: List[str], period: str):
         "all_returns": performances
     }
 
-def compare_volatility(tickers: List[str], period: str):
+def compare_volatility(tickers: List[str], period: str, prices=None):
     """Confronta la volatilità di più ticker per un periodo specifico"""
-    volatilities = {}
-    for t in tickers:
-        vol = get_volatility(t, period)
-        if vol is not None:
-            volatilities[t] = vol
+    stats = close_stats(_histories(tickers, period, prices))
+    volatilities = {t: s["volatility"] for t, s in stats.items() if s["volatility"] is not None}
     
     if not volatilities:
         return {"error": "No volatility data available for tickers"}
@@ -127,13 +361,11 @@ def compare_volatility(tickers: List[str], period: str):
         "all_volatilities": volatilities
     }
 
-def compare_fundamentals(tickers: List[str]):
+def compare_fundamentals(tickers: List[str], fundamentals=None):
     """Confronta i fondamentali di più ticker"""
-    fundamentals_data = {}
-    for t in tickers:
-        fund = get_fundamentals(t)
-        if fund is not None:
-            fundamentals_data[t] = fund
+    if fundamentals is None:
+        fundamentals = get_fundamentals_many(tickers)
+    fundamentals_data = {t: fundamentals[t] for t in tickers if fundamentals.get(t) is not None}
     
     if not fundamentals_data:
         return {"error": "No fundamentals data available for tickers"}
@@ -186,13 +418,10 @@ def compare_fundamentals(tickers: List[str]):
     
     return comparison
 
-def compare_max_min(tickers: List[str], period: str):
+def compare_max_min(tickers: List[str], period: str, prices=None):
     """Confronta i massimi e minimi di più ticker per un periodo specifico"""
-    max_min_data = {}
-    for t in tickers:
-        data = get_max_min(t, period)
-        if data is not None:
-            max_min_data[t] = data
+    stats = close_stats(_histories(tickers, period, prices))
+    max_min_data = {t: {"max": s["max"], "min": s["min"]} for t, s in stats.items()}
     
     if not max_min_data:
         return {"error": "No max/min data available for tickers"}
@@ -216,108 +445,254 @@ def compare_max_min(tickers: List[str], period: str):
         "all_data": max_min_data
     }
 
-# --- Helper to convert frozendict -> dict ---
-def to_dict(obj):
-    """Converte frozendict in dict per la serializzazione JSON"""
-    if isinstance(obj, dict):
-        return {k: to_dict(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [to_dict(i) for i in obj]
-    else:
-        return obj
+# --- Helpers to collect and prefetch the Yahoo data needed by a request ---
+YAHOO_CONCURRENCY = 10  # Richieste a Yahoo in corso contemporaneamente
+yahoo_semaphore = asyncio.Semaphore(YAHOO_CONCURRENCY)
 
-# --- Main endpoint ---
-@app.post("/prompt")
-async def receive_prompt(data: PromptRequest):
-    """
-    Endpoint principale per l'analisi di dati finanziari tramite linguaggio naturale.
-    
-    Accetta una richiesta in linguaggio naturale e restituisce:
-    - Dati strutturati in formato JSON
-    - Analisi in linguaggio naturale
-    """
-    print(f"Received prompt: {data.prompt}")
+async def run_blocking(func, *args):
+    """Esegue una chiamata bloccante a Yahoo in un thread, senza bloccare l'event loop"""
+    async with yahoo_semaphore:
+        return await asyncio.to_thread(func, *args)
 
-    # --- First GPT call: structured JSON with normalized periods ---
-    system_prompt = {
-        "role": "system",
-        "content": (
-            "Sei un assistente finanziario che riceve domande in linguaggio naturale. "
-            "Devi restituire SOLO un JSON valido senza testo extra. "
-            "Struttura JSON: raggruppato per metriche richieste, poi per ticker, poi per periodi/dates. "
-            "Includi solo le metriche effettivamente richieste. "
-            "Normalizza tutti i periodi in termini che Yahoo Finance può comprendere: "
-            "`1mo`, `3mo`, `6mo`, `1y`, `5y`, `ytd` o anni specifici come `2022`, `2025`. "
-            "IMPORTANTE: Se non viene specificato esplicitamente un orizzonte temporale, usa `ytd` (Year-to-Date) come periodo predefinito. "
-            "Esempio generico:\n"
-            "{\n"
-            "  \"return\": {\"AAPL\": {\"1y\": null, \"ytd\": null}},\n"
-            "  \"compare\": {\"return\": {\"AAPL\": {\"ytd\": null}, \"GOOGL\": {\"ytd\": null}}}\n"
-            "}\n"
-            "Ticker: simboli ufficiali (Apple=AAPL, Google=GOOGL). "
-            "Metriche possibili: return, volatility, fundamentals, max_min, compare. "
-            "Non aggiungere testo fuori dal JSON."
+YAHOO_CHART_URL = "https://query2.finance.yahoo.com/v8/finance/chart/{}"
+
+async def fetch_history(ticker, period):
+    """Scarica i prezzi di chiusura di un ticker dall'endpoint chart di Yahoo tramite la sessione persistente"""
+    cached = cache_get(history_ttl_cache, (ticker, period))
+    if cached is not None:
+        return cached
+    try:
+        async with yahoo_semaphore:
+            response = await yahoo_session.get(
+                YAHOO_CHART_URL.format(quote(ticker)),
+                params={"range": period, "interval": "1d"}
+            )
+        response.raise_for_status()
+        indicators = response.json()["chart"]["result"][0]["indicators"]
+        close = _close_array(indicators["quote"][0]["close"])
+    except Exception:
+        return None
+    cache_set(history_ttl_cache, (ticker, period), close)
+    return close
+
+YAHOO_SPARK_URL = "https://query1.finance.yahoo.com/v8/finance/spark"
+
+async def _fetch_spark(tickers, period):
+    """Scarica con una sola richiesta spark i prezzi di chiusura di al massimo 20 ticker"""
+    try:
+        async with yahoo_semaphore:
+            response = await yahoo_session.get(YAHOO_SPARK_URL, params={
+                "symbols": ",".join(tickers),
+                "range": period,
+                "interval": "1d",
+                "indicators": "close",
+                "includeTimestamps": "false"
+            })
+        response.raise_for_status()
+        payload = response.json()
+    except Exception:
+        return {}
+    histories = {}
+    for t in tickers:
+        try:
+            data = payload.get(t) or payload.get(t.upper())
+            histories[t] = _close_array(data["close"])
+        except Exception:
+            continue
+        cache_set(history_ttl_cache, (t, period), histories[t])
+    return histories
+
+async def fetch_histories(tickers, period):
+    """Scarica i prezzi di chiusura di più ticker per un periodo specifico"""
+    histories = {}
+    for t in tickers:
+        cached = cache_get(history_ttl_cache, (t, period))
+        if cached is not None:
+            histories[t] = cached
+    missing = [t for t in tickers if t not in histories]
+    chunks = [missing[i:i + YAHOO_BATCH_SIZE] for i in range(0, len(missing), YAHOO_BATCH_SIZE)]
+    for fetched in await asyncio.gather(*(_fetch_spark(chunk, period) for chunk in chunks)):
+        histories.update(fetched)
+    # I ticker assenti dalla risposta spark ripiegano sull'endpoint chart
+    leftovers = [t for t in missing if histories.get(t) is None]
+    histories.update(zip(leftovers, await asyncio.gather(*(fetch_history(t, period) for t in leftovers))))
+    return histories
+
+def collect_price_requests(parsed):
+    """Raccoglie le coppie (ticker, periodo) uniche richieste dalle metriche sui prezzi"""
+    needed = {}
+    for metric, tickers_data in parsed.items():
+        if metric == "compare":
+            for sub_metric, tickers_cmp in tickers_data.items():
+                if sub_metric not in PRICE_METRICS:
+                    continue
+                # Ogni confronto usa tutti i ticker per ciascun periodo richiesto
+                periods = {period: None for p in tickers_cmp.values() for period in p}
+                for ticker in tickers_cmp:
+                    for period in periods:
+                        needed[(ticker, period)] = None
+        elif metric in PRICE_METRICS:
+            for ticker, periods in tickers_data.items():
+                for period in periods:
+                    needed[(ticker, period)] = None
+    return list(needed)
+
+def collect_fundamentals_requests(parsed):
+    """Raccoglie i ticker unici per cui sono richiesti i fondamentali"""
+    needed = dict.fromkeys(parsed.get("fundamentals", {}))
+    needed.update(dict.fromkeys(parsed.get("compare", {}).get("fundamentals", {})))
+    return list(needed)
+
+async def prefetch_prices(pairs):
+    """Scarica gli storici richiesti con richieste spark in blocco per ciascun periodo"""
+    by_period = {}
+    for ticker, period in pairs:
+        by_period.setdefault(period, []).append(ticker)
+    results = await asyncio.gather(*(
+        fetch_histories(tickers, period) for period, tickers in by_period.items()
+    ))
+    prices = {}
+    for (period, tickers), histories in zip(by_period.items(), results):
+        for t in tickers:
+            prices[(t, period)] = histories.get(t)
+    return prices
+
+async def prefetch_fundamentals(tickers):
+    """Scarica in parallelo i fondamentali dei ticker richiesti"""
+    results = await asyncio.gather(*(run_blocking(get_fundamentals, t) for t in tickers))
+    return dict(zip(tickers, results))
+
+# --- Single-flight for concurrent identical requests ---
+inflight = {}
+
+def request_key(kind, payload):
+    """Chiave di deduplica: tipo di lavoro più SHA-256 del contenuto della richiesta"""
+    return f"{kind}:{hashlib.sha256(payload.encode()).hexdigest()}"
+
+async def single_flight(key, compute):
+    """Esegue compute() una sola volta per chiave: le richieste identiche concorrenti attendono lo stesso risultato"""
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(compute())
+        inflight[key] = task
+        # La chiave viene rimossa a lavoro concluso, anche in caso di errore
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    # shield: se un client si disconnette il lavoro prosegue per gli altri in attesa
+    return await asyncio.shield(task)
+
+# --- Natural language summary helpers ---
+def summary_messages(parsed):
+    """Costruisce i messaggi per la seconda chiamata GPT che riassume il JSON"""
+    # Le istruzioni fisse precedono il JSON variabile, così il prefisso resta identico tra le chiamate
+    nl_prompt = SUMMARY_INSTRUCTIONS + orjson.dumps(parsed).decode()
+    return [{"role": "user", "content": nl_prompt}]
+
+def sse_event(event, data):
+    """Formatta un evento Server-Sent Events con payload JSON"""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+async def stream_summary(parsed):
+    """Invia subito i dati strutturati, poi l'analisi testuale man mano che GPT la genera"""
+    yield sse_event("result", {"status": "ok", "result": parsed})
+    try:
+        stream = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=summary_messages(parsed),
+            temperature=0,
+            stream=True
         )
-    }
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield sse_event("token", chunk.choices[0].delta.content)
+    except Exception as e:
+        yield sse_event("error", f"Failed to generate natural language summary: {e}")
+    yield sse_event("done", None)
 
+# --- Request pipeline ---
+async def build_result(prompt):
+    """Interpreta il prompt con GPT e compila i dati finanziari richiesti"""
+    # --- First GPT call: structured JSON with normalized periods ---
     try:
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4o-mini",
-            messages=[system_prompt, {"role": "user", "content": data.prompt}],
-            temperature=0
+            messages=[SYSTEM_PROMPT, {"role": "user", "content": prompt}],
+            temperature=0,
+            response_format={"type": "json_object"}  # JSON mode: l'output è sempre JSON valido
         )
-        parsed = json.loads(response.choices[0].message.content.strip())
-        parsed = to_dict(parsed)  # Convert frozendict -> dict
+        parsed = orjson.loads(response.choices[0].message.content)
     except Exception as e:
         return {"status": "error", "message": f"Failed to parse JSON from GPT: {e}"}
 
     # --- Backend: fill in the values safely ---
     try:
+        # Scarica ogni storico (ticker, periodo) e ogni fondamentale una sola volta per richiesta,
+        # in parallelo e fuori dall'event loop
+        price_cache, fundamentals_cache = await asyncio.gather(
+            prefetch_prices(collect_price_requests(parsed)),
+            prefetch_fundamentals(collect_fundamentals_requests(parsed)),
+        )
+
         for metric, tickers_data in parsed.items():
             if metric == "compare":
                 for sub_metric, tickers_cmp in tickers_data.items():
-                    for ticker, periods in tickers_cmp.items():
-                        for period in periods:
+                    all_tickers = list(tickers_cmp.keys())
+                    # Il confronto dipende solo dai ticker e dal periodo: si calcola una volta
+                    # per periodo e il risultato sostituisce la struttura ticker -> periodi
+                    if sub_metric == "fundamentals":
+                        try:
+                            tickers_data[sub_metric] = compare_fundamentals(all_tickers, fundamentals_cache)
+                        except Exception:
+                            tickers_data[sub_metric] = None
+                    elif sub_metric in PRICE_METRICS:
+                        compare_periods = {period: None for p in tickers_cmp.values() for period in p}
+                        results = {}
+                        for period in compare_periods:
                             try:
                                 if sub_metric == "return":
-                                    tickers_cmp[ticker][period] = to_dict(compare_returns(list(tickers_cmp.keys()), period))
+                                    results[period] = compare_returns(all_tickers, period, price_cache)
                                 elif sub_metric == "volatility":
-                                    tickers_cmp[ticker][period] = to_dict(compare_volatility(list(tickers_cmp.keys()), period))
-                                elif sub_metric == "fundamentals":
-                                    tickers_cmp[ticker][period] = to_dict(compare_fundamentals(list(tickers_cmp.keys())))
+                                    results[period] = compare_volatility(all_tickers, period, price_cache)
                                 elif sub_metric == "max_min":
-                                    tickers_cmp[ticker][period] = to_dict(compare_max_min(list(tickers_cmp.keys()), period))
+                                    results[period] = compare_max_min(all_tickers, period, price_cache)
                             except Exception:
-                                tickers_cmp[ticker][period] = None
+                                results[period] = None
+                        tickers_data[sub_metric] = results
             else:
                 for ticker, periods in tickers_data.items():
                     # Gestione speciale per fundamentals (non ha periodi)
                     if metric == "fundamentals":
-                        try:
-                            tickers_data[ticker] = get_fundamentals(ticker)
-                        except Exception:
-                            tickers_data[ticker] = None
+                        tickers_data[ticker] = fundamentals_cache.get(ticker)
                     else:
                         # Altre metriche con periodi
                         for period in periods:
                             try:
                                 if metric == "return":
-                                    periods[period] = get_return(ticker, period)
+                                    periods[period] = _compute_return(price_cache.get((ticker, period)))
                                 elif metric == "volatility":
-                                    periods[period] = get_volatility(ticker, period)
+                                    periods[period] = _compute_volatility(price_cache.get((ticker, period)))
                                 elif metric == "max_min":
-                                    periods[period] = get_max_min(ticker, period)
+                                    periods[period] = _compute_max_min(price_cache.get((ticker, period)))
                             except Exception:
                                 periods[period] = None
     except Exception as e:
         return {"status": "error", "message": f"Failed to fetch data: {e}"}
 
+    return {"status": "ok", "result": parsed}
+
+async def build_response(data: PromptRequest):
+    """Costruisce la risposta JSON completa: dati strutturati e analisi testuale"""
+    result = await single_flight(request_key("result", data.prompt), lambda: build_result(data.prompt))
+    if result["status"] != "ok":
+        return result
+    parsed = result["result"]
+    if not data.include_nl:
+        return {"status": "ok", "result": parsed}
+
     # --- Second GPT call: summarize JSON in natural language ---
     try:
-        nl_prompt = f"Analizza questo JSON finanziario e crea una risposta professionale e ben strutturata in italiano. Usa un formato chiaro con paragrafi separati, numerazione quando appropriato, e un linguaggio tecnico ma accessibile. Includi sempre i valori numerici specifici e le percentuali. Struttura la risposta in questo modo: 1) Introduzione breve, 2) Dati principali con valori specifici, 3) Analisi comparativa se presente, 4) Conclusioni. JSON: {json.dumps(parsed)}"
-        nl_response = client.chat.completions.create(
+        nl_response = await client.chat.completions.create(
             model="gpt-4o-mini",
-            messages=[{"role": "user", "content": nl_prompt}],
+            messages=summary_messages(parsed),
             temperature=0
         )
         nl_text = nl_response.choices[0].message.content.strip()
@@ -330,6 +705,35 @@ async def receive_prompt(data: PromptRequest):
         "natural_language": nl_text
     }
 
+# --- Main endpoint ---
+@app.post("/prompt", response_class=ORJSONResponse)
+async def receive_prompt(data: PromptRequest):
+    """
+    Endpoint principale per l'analisi di dati finanziari tramite linguaggio naturale.
+    
+    Accetta una richiesta in linguaggio naturale e restituisce:
+    - Dati strutturati in formato JSON
+    - Analisi in linguaggio naturale
+
+    Con `stream: true` la risposta è uno stream Server-Sent Events: un evento `result`
+    con i dati strutturati, eventi `token` con l'analisi testuale e infine `done`.
+    Con `include_nl: false` l'analisi testuale viene saltata e `natural_language` è assente.
+    """
+    print(f"Received prompt: {data.prompt}")
+
+    if data.stream and data.include_nl:
+        # Lo stream non si può condividere: si condividono solo i dati strutturati
+        result = await single_flight(request_key("result", data.prompt), lambda: build_result(data.prompt))
+        if result["status"] != "ok":
+            return result
+        return StreamingResponse(
+            stream_summary(result["result"]),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"}
+        )
+
+    return await single_flight(request_key("response", data.model_dump_json()), lambda: build_response(data))
+
 @app.get("/")
 async def root():
     """Endpoint di benvenuto con informazioni sull'API"""
@@ -347,4 +751,7 @@ async def root():
 if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host=host, port=port)
+    workers = int(os.getenv("WORKERS", 4))
+    # "auto" usa uvloop e httptools (inclusi in uvicorn[standard]) dove disponibili,
+    # con ripiego su asyncio/h11 dove non lo sono (es. uvloop su Windows)
+    uvicorn.run("main:app", host=host, port=port, workers=workers, loop="auto", http="auto")